@@ -0,0 +1,316 @@
+import os
+import time
+import yaml
+import shutil
+import tempfile
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+from glob import glob
+from moviepy.editor import VideoClip, VideoFileClip
+from biliwalle.clipcreator import make_clip_with_protocol
+from biliwalle.biliwalle import make_movie_with_protocol
+from biliwalle.machine_profile import save_profile
+
+
+def process_memory_kb(pid):
+    '''
+        Proportional set size of a process on linux, so that the pages a
+        forked worker shares with its parent are counted once.
+        None where /proc is not available.
+    '''
+    try:
+        with open("/proc/%s/smaps_rollup"%pid) as fh:
+            for line in fh:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        return None
+    return None
+
+
+def tree_memory_mb(pid):
+    '''
+        Memory of a process and all its descendants (workers, ffmpeg),
+        resident set size from ps where the proportional one is unknown
+    '''
+    try:
+        out = subprocess.run(["ps", "-A", "-o", "pid=,ppid=,rss="],
+                             stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+    except OSError:
+        return np.nan
+    children, rss = {}, {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) != 3:
+            continue
+        p, ppid, kb = map(int, fields)
+        children.setdefault(ppid, []).append(p)
+        rss[p] = kb
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    total = 0
+    for p in pids:
+        kb = process_memory_kb(p)
+        total += kb if kb is not None else rss.get(p, 0)
+    return total / 1024
+
+
+def synthetic_clip(duration, size, seed=0):
+    '''
+        A moving gradient with static grain, standing in for a source video
+    '''
+    w, h = size
+    gradient = np.tile(np.linspace(0, 191, w).astype("uint8"), (h, 1))
+    base = np.dstack([gradient, gradient[::-1], gradient[:, ::-1]])
+    noise = np.random.RandomState(seed).randint(0, 64, (h, w, 3))\
+              .astype("uint8")
+
+    def make_frame(t):
+        return np.roll(base, int(t * 200) % w, axis=1) + noise
+
+    return VideoClip(make_frame, duration=duration)
+
+
+def write_sources(videodir, n_sources, duration, size, fps=30):
+    '''
+        Encode synthetic source videos once, the trials decode them
+    '''
+    names = []
+    for i in range(n_sources):
+        name = "sample%02d"%i
+        clip = synthetic_clip(duration, size, seed=i)
+        clip.write_videofile(os.path.join(videodir, name + ".mp4"),
+                             fps=fps, codec='libx264', preset='ultrafast',
+                             logger=None)
+        clip.close()
+        names.append(name)
+    return names
+
+
+def sample_protocol(tool, video_setting, names, rows_per_group, duration):
+    '''
+        A protocol of independent groups of rows_per_group outputs, each
+        group sharing its own pair of source videos the way test protocols
+        do, so that there are as many batches to run in parallel as pairs
+        in names. For clipcreator or biliwalle.
+    '''
+    rows = []
+    for g in range(len(names) // 2):
+        pair = names[2 * g:2 * g + 2]
+        for i in range(rows_per_group):
+            first, second = pair[i % 2], pair[(i + 1) % 2]
+            n = g * rows_per_group + i
+            outname = "out%02d.mp4"%n
+            if tool == "biliwalle":
+                for videoname in (first, second):
+                    rows.append({"Order": n,
+                                 "Video_file": videoname + ".mp4",
+                                 "Trial_type": "test",
+                                 "Output_video_file": outname})
+            elif "Left" in video_setting.get("objects", {}):
+                rows.append({"Test_trial_ID": n, "Left": first,
+                             "Right": second,
+                             "Audio_file": "silence_%ss"%duration,
+                             "Output_file": outname})
+            else:
+                # a single source per row, keep the group on one source
+                rows.append({"Training_trial_ID": n, "Object": pair[0],
+                             "Audio_file": "silence_%ss"%duration,
+                             "Output_file": outname})
+    return pd.DataFrame(rows)
+
+
+def render_sample(queue, tool, protocoldf, videodir, outdir, video_setting,
+                  fps, jobs, threads, preset):
+    '''
+        Trial run in a fresh process, puts the render wall time and the
+        duration of the rendered outputs in queue
+    '''
+    start = time.time()
+    if tool == "biliwalle":
+        make_movie_with_protocol(protocoldf, outdir, videodir,
+                                 video_setting, fps=fps, preset=preset,
+                                 threads=threads, jobs=jobs, verbose=0)
+    else:
+        make_clip_with_protocol(protocoldf, outdir, videodir + "/",
+                                videodir, video_setting, fps=fps,
+                                preset=preset, threads=threads, jobs=jobs,
+                                verbose=0)
+    wall = time.time() - start
+
+    seconds = 0
+    for fn in glob(os.path.join(outdir, "*.mp4")):
+        clip = VideoFileClip(fn)
+        seconds += clip.duration
+        clip.close()
+    queue.put((wall, seconds))
+
+
+def run_trial(tool, protocoldf, videodir, outdir, video_setting, fps,
+              jobs, threads, preset, interval=0.1):
+    '''
+        Render the sample protocol with the given setting, returns the
+        throughput (output seconds per wall second) and the peak memory
+        in MB of the whole process tree
+    '''
+    # spawned, so that the memory of this process isn't inherited
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=render_sample,
+                       args=(queue, tool, protocoldf, videodir, outdir,
+                             video_setting, fps, jobs, threads, preset))
+    proc.start()
+    peak = 0
+    while proc.is_alive():
+        peak = max(peak, tree_memory_mb(proc.pid))
+        time.sleep(interval)
+    proc.join()
+    if proc.exitcode != 0:
+        raise Exception("Trial jobs %s, threads %s, preset %s failed"\
+                        %(jobs, threads, preset))
+    wall, seconds = queue.get()
+    return seconds / wall, peak
+
+
+def autotune(video_setting, tool="clipcreator", duration=3, fps=30,
+             rows_per_group=2,
+             jobs_list=None, threads_list=None,
+             presets=("veryfast", "medium"),
+             memory_limit_mb=None,
+             verbose=1):
+    '''
+        Sweep jobs x threads x preset on a sample protocol rendered with
+        the configured layout (including memory_budget_mb), returns the
+        results table sorted by throughput, the best setting within
+        memory_limit_mb first.
+        The sample has one independent group of outputs per job of the
+        largest jobs value, so that every jobs value runs in parallel.
+        Oversubscribed combinations (jobs x threads > 2 x cpus) are
+        skipped with a warning, ValueError if none is left.
+    '''
+    ncpu = multiprocessing.cpu_count()
+    default = [n for n in (1, 2, 4, 8) if n <= ncpu]
+    settings = []
+    for jobs, threads, preset in itertools.product(jobs_list or default,
+                                                   threads_list or default,
+                                                   presets):
+        if jobs * threads > 2 * ncpu:
+            print("WARNING: SKIP jobs %s, threads %s, preset %s, "
+                  "oversubscribes %s cpus"%(jobs, threads, preset, ncpu))
+            continue
+        settings.append((jobs, threads, preset))
+    if not settings:
+        raise ValueError("every jobs x threads combination oversubscribes "
+                         "the %s cpus of this machine (jobs x threads > %s), "
+                         "try smaller --jobs or --threads"%(ncpu, 2 * ncpu))
+
+    size = (video_setting["out_width"], video_setting["out_height"])
+    n_groups = max(jobs for jobs, _, _ in settings)
+
+    results = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        videodir = os.path.join(tmpdir, "videos")
+        os.makedirs(videodir)
+        names = write_sources(videodir, 2 * n_groups, duration, size,
+                              fps=fps)
+        protocoldf = sample_protocol(tool, video_setting, names,
+                                     rows_per_group, duration)
+
+        for jobs, threads, preset in settings:
+            outdir = os.path.join(tmpdir, "out")
+            throughput, peak = run_trial(tool, protocoldf, videodir,
+                                         outdir, video_setting, fps,
+                                         jobs, threads, preset)
+            shutil.rmtree(outdir)
+            if verbose:
+                print("jobs %s, threads %s, preset %s: "
+                      "%.2f output s/s, peak memory %.0f MB"\
+                      %(jobs, threads, preset, throughput, peak))
+            results.append(dict(jobs=jobs, threads=threads, preset=preset,
+                                throughput=throughput,
+                                peak_memory_mb=peak))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    resultdf = pd.DataFrame(results)
+    resultdf["within_memory_limit"] = True
+    if memory_limit_mb:
+        resultdf["within_memory_limit"] = \
+            ~(resultdf["peak_memory_mb"] > memory_limit_mb)
+    resultdf = resultdf.sort_values(["within_memory_limit", "throughput"],
+                                    ascending=False)\
+                       .reset_index(drop=True)
+    return resultdf
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find the fastest encoding settings on this machine')
+    parser.add_argument('-c', '--config', required=True,
+           help="clipcreator or biliwalle configuration file, "
+                "the sample is rendered with its video_setting")
+    parser.add_argument('-t', '--tool', choices=["clipcreator", "biliwalle"],
+           help="tool to tune, by default guessed from the config")
+    parser.add_argument('-d', '--duration', default=3, type=int,
+           help="duration in seconds of each sample source video")
+    parser.add_argument('-r', '--rows_per_group', default=2, type=int,
+           help="outputs sharing source videos in each group of the "
+                "sample protocol, there is one group per job")
+    parser.add_argument('--jobs', nargs='+', type=int,
+           help="parallel renders to try, default 1 2 4 8 up to cpu count")
+    parser.add_argument('--threads', nargs='+', type=int,
+           help="encoder threads to try, default 1 2 4 8 up to cpu count")
+    parser.add_argument('--presets', nargs='+',
+           default=["veryfast", "medium"],
+           help="x264 presets to try")
+    parser.add_argument('-m', '--memory_limit', type=float,
+           help="maximum peak memory in MB of the chosen setting")
+    parser.add_argument('-o', '--profile',
+           help="machine profile to write, by default the one loaded by "
+                "the tool: ~/.biliwalle/TOOL_profile.yml, "
+                "or in BILIWALLE_PROFILE_DIR")
+    parser.add_argument('-v', '--verbose', default=1, type=int,
+           help="verbose level, 0 or 1")
+    args = parser.parse_args()
+
+    with open(args.config) as fh:
+        config = yaml.load(fh, Loader=yaml.Loader)
+    video_setting = config.get("video_setting", {})
+    tool = args.tool or \
+        ("clipcreator" if "objects" in video_setting else "biliwalle")
+
+    try:
+        resultdf = autotune(video_setting, tool=tool,
+                            duration=args.duration,
+                            rows_per_group=args.rows_per_group,
+                            jobs_list=args.jobs, threads_list=args.threads,
+                            presets=args.presets,
+                            memory_limit_mb=args.memory_limit,
+                            verbose=args.verbose)
+    except ValueError as e:
+        parser.error(str(e))
+    print("\n", resultdf.to_string())
+
+    best = resultdf.iloc[0]
+    if not best["within_memory_limit"]:
+        print("\nWARNING: no setting fits in %s MB, using the fastest"\
+              %args.memory_limit)
+    profile = dict(jobs=int(best["jobs"]), threads=int(best["threads"]),
+                   preset=str(best["preset"]),
+                   throughput=float(best["throughput"]),
+                   peak_memory_mb=float(best["peak_memory_mb"]))
+    profilefn = save_profile(profile, tool, args.profile)
+    print("\nWrote %s: jobs %s, threads %s, preset %s"\
+          %(profilefn, profile["jobs"], profile["threads"], profile["preset"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,12 @@ import tempfile
 import argparse
 import pandas as pd
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw
 from moviepy.editor import VideoFileClip, ImageClip,\
                            concatenate_videoclips
+from biliwalle.watch import watch, config_paths, SourceCache
+from biliwalle.machine_profile import load_profile
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -51,6 +54,76 @@ def blank_clip(duration, bg_color, size):
     return clip
 
 
+def render_movie(grp, order, outname, videodir, size,
+                 between_trial_duration,
+                 between_trial_bgcolor,
+                 video_file_col="Video_file",
+                 trial_type_col="Trial_type",
+                 fps=30,
+                 codec='libx264',
+                 preset='medium',
+                 threads=None,
+                 verbose=1,
+                 source_cache=None):
+    '''
+        Concatenate the trials of one output movie
+    '''
+    w, h = size
+    videos = []
+
+    if verbose:
+        print("\n\n")
+        print("#"*80)
+        print("Generating %sth file to %s\n"%(int(order), outname))
+
+    for _, row in tqdm(grp.iterrows()):
+        videofn = row[video_file_col]
+        trial_type = row[trial_type_col]
+
+        if trial_type.lower() == "transition":
+            # expect to see videofn color_[0-9]s
+            bg_color, duration = videofn.split("_")
+            duration = int(re.findall("([0-9]*)s", duration)[0])
+            video = blank_clip(duration, bg_color.lower(), size=(w,h))
+            videos.append(video)
+        else:
+            videofn = os.path.join(videodir, videofn)
+            if os.path.exists(videofn):
+                if source_cache is not None:
+                    video = source_cache.get(videofn, VideoFileClip)
+                else:
+                    video = VideoFileClip(videofn)
+                video = video.resize(height=h, width=w)
+                videos.append(video)
+                # between trial interval
+                interval_video = blank_clip(between_trial_duration, 
+                        between_trial_bgcolor.lower(), size=(w,h))
+                videos.append(interval_video)
+            else:
+                print("SKIP %s doesn't exist"%videofn)
+                continue
+
+    outvideo = concatenate_videoclips(videos, method="compose")
+    if verbose:
+        print("\nWriting to %s"%outname)
+        logger = "bar"
+    else:
+        logger = None
+    outvideo.write_videofile(outname, codec=codec,
+                            audio_codec='aac',
+                            remove_temp=True,
+                            fps=fps,
+                            preset=preset,
+                            threads=threads,
+                            logger=logger)
+        
+    # close the opened videos, cached ones share their readers
+    if source_cache is None:
+        for v in videos:
+            v.close()
+        outvideo.close()
+
+
 def make_movie_with_protocol(protocoldf,
                              outdir,
                              videodir,
@@ -61,13 +134,26 @@ def make_movie_with_protocol(protocoldf,
                              outname_col="Output_video_file",
                              fps=30,
                              codec='libx264',
+                             preset='medium',
+                             threads=None,
+                             jobs=1,
                              color_dict={
                                  "black": (0, 0, 0),
                                  "white": (255, 255, 255)
                              },
                              verbose=1,
-                             reprocess=True):
-
+                             reprocess=True,
+                             source_cache=None,
+                             done=None):
+    '''
+        preset, threads: x264 settings; jobs: number of movies rendered
+        in parallel processes, see biliwalle.autotune
+        source_cache: opened videos shared between calls in watch mode,
+        cached videos stay open after the call
+        done: if given, called as done(outname, error) after each movie,
+        error is None on success. A failed movie is then reported there
+        and the other movies are still rendered.
+    '''
     w = video_setting["out_width"]
     h = video_setting["out_height"]
     between_trial = video_setting.get("between_trial", None)
@@ -76,8 +162,8 @@ def make_movie_with_protocol(protocoldf,
 
     if not os.path.exists(outdir): os.makedirs(outdir)
 
+    movies = []
     for order, grp in protocoldf.groupby(order_col):
-        videos = [] 
         outname = grp[outname_col].values[0]
         outname = os.path.join(outdir, outname)
 
@@ -87,52 +173,133 @@ def make_movie_with_protocol(protocoldf,
                 print("#"*80)
                 print("\nSKIP found existing %s\n"%outname)
             continue
-        
-        if verbose:
-            print("\n\n")
-            print("#"*80)
-            print("Generating %sth file to %s\n"%(int(order), outname))
-
-        for _, row in tqdm(grp.iterrows()):
-            videofn = row[video_file_col]
-            trial_type = row[trial_type_col]
-
-            if trial_type.lower() == "transition":
-                # expect to see videofn color_[0-9]s
-                bg_color, duration = videofn.split("_")
-                duration = int(re.findall("([0-9]*)s", duration)[0])
-                video = blank_clip(duration, bg_color.lower(), size=(w,h))
-                videos.append(video)
-            else:
-                videofn = os.path.join(videodir, videofn)
-                if os.path.exists(videofn):
-                    video = VideoFileClip(videofn)
-                    video = video.resize(height=h, width=w)
-                    videos.append(video)
-                    # between trial interval
-                    interval_video = blank_clip(between_trial_duration, 
-                            between_trial_bgcolor.lower(), size=(w,h))
-                    videos.append(interval_video)
-                else:
-                    print("SKIP %s doesn't exist"%videofn)
-                    continue
+        movies.append((grp, order, outname))
 
-        outvideo = concatenate_videoclips(videos, method="compose")
-        if verbose:
-            print("\nWriting to %s"%outname)
-            logger = "bar"
+    kwargs = dict(videodir=videodir, size=(w, h),
+                  between_trial_duration=between_trial_duration,
+                  between_trial_bgcolor=between_trial_bgcolor,
+                  video_file_col=video_file_col,
+                  trial_type_col=trial_type_col,
+                  fps=fps, codec=codec, preset=preset, threads=threads,
+                  verbose=verbose)
+    def finish(outname, result):
+        try:
+            result()
+        except Exception as e:
+            if done is None:
+                raise
+            done(outname, e)
         else:
-            logger = None
-        outvideo.write_videofile(outname, codec=codec,
-                                audio_codec='aac',
-                                remove_temp=True,
-                                fps=fps,
-                                logger=logger)
-            
-        # close the opened videos
-        for v in videos:
-            v.close()
-        outvideo.close()
+            if done is not None:
+                done(outname, None)
+
+    if jobs > 1 and len(movies) > 1:
+        # the source cache can't be shared, workers open their own videos
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_movie, grp, order, outname,
+                                       **kwargs)
+                       for grp, order, outname in movies]
+            for (_, _, outname), future in zip(movies, futures):
+                finish(outname, future.result)
+    else:
+        for grp, order, outname in movies:
+            finish(outname, lambda: render_movie(grp, order, outname,
+                                                 source_cache=source_cache,
+                                                 **kwargs))
+
+
+def group_signature(grp, videodir, video_setting,
+                    video_file_col="Video_file"):
+    '''
+        Everything an output movie depends on: its protocol rows,
+        the video setting and the mtimes of its video files
+    '''
+    mtimes = []
+    for videofn in grp[video_file_col]:
+        videofn = os.path.join(videodir, str(videofn))
+        if os.path.exists(videofn):
+            mtimes.append((videofn, os.path.getmtime(videofn)))
+    return (repr(grp.to_dict("records")), repr(video_setting),
+            tuple(mtimes))
+
+
+def watch_movie_with_protocol(configfn, interval=1.0, verbose=1,
+                              order_col="Order",
+                              outname_col="Output_video_file",
+                              max_sources=32, **kwargs):
+    '''
+        Stay resident, re-render the movies affected by each change of the
+        config, the protocol csv or the video directory
+        max_sources: number of opened videos kept between renders
+        kwargs: encoding settings passed to make_movie_with_protocol,
+        rendering stays in this process (jobs=1) to keep the caches warm
+    '''
+    kwargs["jobs"] = 1
+    source_cache = SourceCache(max_sources=max_sources)
+    rendered = {}  # output file -> group signature of its last render
+
+    def render(old, new):
+        if set(old) != set(new):
+            source_cache.prune()
+        videodir, outdir, protocoldf, saveconfig, video_setting,\
+            config, reprocess = \
+            load_config(configfn)
+        todo, signatures, referenced = [], {}, set()
+        for order, grp in protocoldf.groupby(order_col):
+            outname = os.path.join(outdir, grp[outname_col].values[0])
+            signature = group_signature(grp, videodir, video_setting)
+            referenced.update(fn for fn, _ in signature[2])
+            if rendered.get(outname) == signature:
+                continue
+            if not rendered and not reprocess and os.path.exists(outname):
+                # the first pass follows the config
+                if verbose:
+                    print("\nSKIP found existing %s"%outname)
+                rendered[outname] = signature
+                continue
+            todo.append(order)
+            signatures[outname] = signature
+        # close the videos the protocol doesn't use anymore
+        source_cache.retain(referenced)
+        if not todo:
+            return
+        if verbose and rendered:
+            print("\nChange detected, re-rendering %s movie(s)"%len(todo))
+
+        failed = []
+
+        def done(outname, error):
+            # record each movie as it finishes, a bad one doesn't make
+            # the others render again
+            if error is None:
+                rendered[outname] = signatures[outname]
+            else:
+                print("\n\nWARNING: ", error)
+                print("FAILED %s\n\n"%outname)
+                failed.append(outname)
+
+        make_movie_with_protocol(protocoldf[protocoldf[order_col].isin(todo)],
+                                 outdir,
+                                 videodir,
+                                 video_setting,
+                                 order_col=order_col,
+                                 outname_col=outname_col,
+                                 verbose=verbose,
+                                 reprocess=True,
+                                 source_cache=source_cache,
+                                 done=done,
+                                 **kwargs)
+        source_cache.retain()
+        if saveconfig:
+            shutil.copy(configfn, outdir)
+        if failed:
+            raise Exception("%s movie(s) failed to render"%len(failed))
+
+    try:
+        watch(lambda: config_paths(configfn, keys=("protocolcsv", "videodir")),
+              render, interval=interval, verbose=verbose)
+    finally:
+        source_cache.close()
 
 
 def main():
@@ -141,7 +308,19 @@ def main():
            help="configuration file for concatenating audio files")
     parser.add_argument('-v', '--verbose', default=1, type=int,
            help="verbose level, 0 or 1")
+    parser.add_argument('-w', '--watch', action='store_true',
+           help="keep running and re-render movies when the config, "
+                "protocol csv or video files change")
+    parser.add_argument('--interval', default=1.0, type=float,
+           help="polling interval in seconds for --watch")
     args = parser.parse_args()
+
+    # encoding settings written by the autotune command
+    profile = load_profile("biliwalle", verbose=args.verbose)
+    if args.watch:
+        watch_movie_with_protocol(args.config, interval=args.interval,
+                                  verbose=args.verbose, **profile)
+        return
     
     videodir, outdir, protocoldf, saveconfig, video_setting,\
         config, reprocess = \
@@ -151,7 +330,8 @@ def main():
                              videodir,
                              video_setting,
                              verbose=args.verbose,
-                             reprocess=reprocess)
+                             reprocess=reprocess,
+                             **profile)
 
     if saveconfig:
         shutil.copy(args.config, outdir)
@@ -5,10 +5,18 @@ import shutil
 import argparse
 import mimetypes
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+from tqdm import tqdm
 from moviepy.editor import ImageClip, VideoFileClip, \
                         CompositeVideoClip, AudioFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 from biliwalle.waveweaver import empty_audio_clip
+from biliwalle.watch import watch, config_paths, GlobCache, SourceCache
+from biliwalle.machine_profile import load_profile
+
+# frames buffered by one x264 encoder, used to size the fan-out
+ENCODER_BUFFER_FRAMES = 60
 
 
 def load_config(configfn):
@@ -71,12 +79,18 @@ def image_to_video(imagefn, duration):
 
 
 def process_video(fn, resize_to_width, resize_to_height,
-                  position_x, position_y, duration=None):
+                  position_x, position_y, duration=None,
+                  source_cache=None):
     x, y = center_to_topleft(position_x, position_y, 
                              resize_to_width, resize_to_height)
     fn_type = check_image_or_video(fn)
     if fn_type == 'video':
-        video = VideoFileClip(fn)
+        if source_cache is not None:
+            # shared by the rows of a batch, the reader returns its last
+            # frame when the position is unchanged, decoding it once
+            video = source_cache.get(fn, VideoFileClip)
+        else:
+            video = VideoFileClip(fn)
     else:
         video = image_to_video(fn, duration=duration)
     try:
@@ -90,13 +104,56 @@ def process_video(fn, resize_to_width, resize_to_height,
     return video
 
 
-def process_audio(audiofn, audiodir, fps=44100):
-    if "silence" not in audiofn.lower():
-        n_audiofn = glob(audiodir+audiofn)
-        if not len(n_audiofn):
-            raise Exception("\n\nSKIP WARNING: %s in not found in sub directory of %s"\
-                    %(audiofn, audiodir))
-        audio = AudioFileClip(n_audiofn[0])
+def find_audio(audiofn, audiodir, globber=glob):
+    '''
+        Path of the audio file of a protocol row, None for silence
+    '''
+    if "silence" in audiofn.lower():
+        return None
+    n_audiofn = globber(audiodir+audiofn)
+    if not len(n_audiofn):
+        raise Exception("\n\nSKIP WARNING: %s in not found in sub directory of %s"\
+                %(audiofn, audiodir))
+    return n_audiofn[0]
+
+
+def find_video(videodir, name, globber=glob):
+    p = videodir+"/%s*"%name
+    video_fns = globber(p)
+    assert len(video_fns) == 1, \
+        f"File pattern {p} is found {len(video_fns)} times, please make sure it's unique" 
+    return video_fns[0]
+
+
+def find_row_videos(row, columns, videodir, video_setting,
+                    test_identifier="Test_trial_ID",
+                    train_identifier="Training_trial_ID",
+                    globber=glob):
+    '''
+        List of (video file, object setting) used by a protocol row
+    '''
+    if test_identifier in columns:
+        # for testing movie making with left/right objects
+        keys = ["Left", "Right"]
+    elif train_identifier in columns:
+        # for training movie making with center object
+        keys = ["Object"]
+    else:
+        raise Exception("Neither %s or %s can be found in the columns;\
+                         Make sure you have the right protocol csv fomat"\
+                         %(test_identifier, train_identifier))
+    return [(find_video(videodir, row[k], globber),
+             video_setting["objects"][k]) for k in keys]
+
+
+def process_audio(audiofn, audiodir, fps=44100,
+                  globber=glob, source_cache=None):
+    n_audiofn = find_audio(audiofn, audiodir, globber)
+    if n_audiofn is not None:
+        if source_cache is not None:
+            audio = source_cache.get(n_audiofn, AudioFileClip)
+        else:
+            audio = AudioFileClip(n_audiofn)
     else:
         audiofn = audiofn.lower()
         silence_duraion = int(re.findall("([0-9]+)",
@@ -106,16 +163,172 @@ def process_audio(audiofn, audiodir, fps=44100):
     return audio
 
 
+def max_fanout_sinks(width, height, memory_budget_mb):
+    '''
+        Number of outputs that can be encoded at the same time within the
+        memory budget, each x264 encoder buffers its lookahead and
+        reference frames (yuv420, 1.5 bytes per pixel)
+    '''
+    sink_bytes = width * height * 3 // 2 * ENCODER_BUFFER_FRAMES
+    return max(1, int(memory_budget_mb * 1024 ** 2 // sink_bytes))
+
+
+def schedule_by_source(plans, max_sinks):
+    '''
+        plans: list of (row, outname, [(video file, object setting)])
+        Group the plans connected by any shared video file, and split
+        each group in batches of at most max_sinks plans. Plans with the
+        same sources are next to each other in a group.
+    '''
+    groups = []  # [(plans, video files)]
+    for plan in plans:
+        members = [plan]
+        fns = set(fn for fn, _ in plan[2])
+        rest = []
+        for grp, grp_fns in groups:
+            if grp_fns & fns:
+                members = grp + members
+                fns |= grp_fns
+            else:
+                rest.append((grp, grp_fns))
+        groups = rest + [(members, fns)]
+
+    batches = []
+    for grp, _ in groups:
+        grp = sorted(grp, key=lambda plan: sorted(fn for fn, _ in plan[2]))
+        for i in range(0, len(grp), max_sinks):
+            batches.append(grp[i:i+max_sinks])
+    return batches
+
+
+def write_clip(outvideo, outname, fps=30, codec='libx264',
+               preset='medium', threads=None, verbose=1):
+    if verbose:
+        print("\nWriting to %s"%outname)
+        logger = "bar"
+    else:
+        logger = None
+    
+    outvideo.write_videofile(outname, codec=codec,
+                             audio_codec='aac',
+                             remove_temp=True,
+                             fps=fps,
+                             preset=preset,
+                             threads=threads,
+                             logger=logger)
+
+
+def write_clips_fanout(outvideos, outnames, fps=30, codec='libx264',
+                       preset='medium', threads=None, verbose=1):
+    '''
+        Write several clips in a single pass over time. The sources they
+        share are read once per frame, which is fanned out to one ffmpeg
+        encoder per output.
+    '''
+    writers, audiofns = [], []
+    try:
+        for outvideo, outname in zip(outvideos, outnames):
+            if verbose:
+                print("\nWriting to %s"%outname)
+            audiofn = None
+            if outvideo.audio is not None:
+                audiofn = os.path.splitext(outname)[0] + \
+                          "TEMP_MPY_wvf_snd.m4a"
+                audiofns.append(audiofn)
+                outvideo.audio.write_audiofile(audiofn, fps=44100,
+                                               codec='aac', logger=None)
+            writers.append(FFMPEG_VideoWriter(outname, outvideo.size, fps,
+                                              codec=codec,
+                                              audiofile=audiofn,
+                                              preset=preset,
+                                              threads=threads))
+
+        nframes = [int(v.duration * fps) for v in outvideos]
+        for i in tqdm(range(max(nframes)), disable=not verbose):
+            t = i / fps
+            for outvideo, writer, n in zip(outvideos, writers, nframes):
+                if i < n:
+                    writer.write_frame(outvideo.get_frame(t).astype("uint8"))
+    finally:
+        for writer in writers:
+            writer.close()
+        for audiofn in audiofns:
+            if os.path.exists(audiofn):
+                os.remove(audiofn)
+
+
+def render_batch(batch, audiodir, output_size, bg_color,
+                 fps=30,
+                 codec='libx264',
+                 preset='medium',
+                 threads=None,
+                 verbose=1,
+                 globber=glob,
+                 source_cache=None):
+    '''
+        Render a batch of planned rows from schedule_by_source
+    '''
+    # sources are opened once per batch, unless cached across calls
+    cache = source_cache if source_cache is not None else SourceCache()
+    try:
+        outvideos, outnames = [], []
+        for row, outname, videos in batch:
+            # process audio file
+            audio = process_audio(row["Audio_file"], audiodir,
+                                  globber=globber,
+                                  source_cache=cache)
+            duration = audio.duration
+            clips = [process_video(video_fn, duration=duration,
+                                   source_cache=cache,
+                                   **object_setting)
+                     for video_fn, object_setting in videos]
+
+            # compose
+            outvideos.append(compose(videos=clips,
+                                     audio=audio,
+                                     output_size=output_size,
+                                     bg_color=bg_color))
+            outnames.append(outname)
+
+        if len(outvideos) == 1:
+            write_clip(outvideos[0], outnames[0], fps=fps, codec=codec,
+                       preset=preset, threads=threads, verbose=verbose)
+        else:
+            write_clips_fanout(outvideos, outnames, fps=fps, codec=codec,
+                               preset=preset, threads=threads,
+                               verbose=verbose)
+    finally:
+        # close the opened videos
+        if source_cache is None:
+            cache.close()
+
+
 def make_clip_with_protocol(protocoldf, outdir, 
                              audiodir, videodir, video_setting,
                              test_identifier="Test_trial_ID",
                              train_identifier="Training_trial_ID",
                              fps=30,
                              codec='libx264',
+                             preset='medium',
+                             threads=None,
+                             jobs=1,
                              verbose=1,
-                             reprocess=True):
+                             reprocess=True,
+                             globber=glob,
+                             source_cache=None,
+                             done=None):
     '''
         Make movie based on the protocol table
+        Rows sharing source videos are rendered together, decoding each
+        shared source once, with as many outputs at a time as
+        video_setting["memory_budget_mb"] allows.
+        preset, threads: x264 settings; jobs: number of batches rendered
+        in parallel processes, see biliwalle.autotune
+        globber, source_cache: lookups and opened sources shared between
+        calls in watch mode. Cached sources stay open after the call.
+        done: if given, called as done(outnames, error) after each batch,
+        error is None on success. A failed batch is then reported there
+        and the other batches are still rendered.
     '''
     w = video_setting["out_width"]
     h = video_setting["out_height"]
@@ -123,81 +336,158 @@ def make_clip_with_protocol(protocoldf, outdir,
     bg_color = tuple(bg_color)
     assert len(bg_color) == 3,\
         "Please provide bg_color in RGB format in the config, such as [255, 255, 255]"
+    # the memory budget is shared by the parallel jobs
+    max_sinks = max_fanout_sinks(w, h,
+                    video_setting.get("memory_budget_mb", 1024) / jobs)
 
     if not os.path.exists(outdir): os.makedirs(outdir)
 
+    # plan the rows to render with their source videos
+    plans = []
     for _, row in protocoldf.iterrows():
         outname = os.path.join(outdir, row["Output_file"])
-        
-        # process audio file
-        audio = process_audio(row["Audio_file"], audiodir)
-        duration = audio.duration
 
         if os.path.exists(outname) and (not reprocess):
             if verbose:
                 print("\nSKIP found existing %s"%outname)
             continue
-            
-        if test_identifier in protocoldf.columns:
-            # for testing movie making with left/right objects
-            p = videodir+"/%s*"%row["Left"]
-            left_video_fns = glob(p)
-            assert len(left_video_fns) == 1, \
-                f"File pattern {p} is found {len(left_video_fns)} times, please make sure it's unique" 
-            left_video_fn = left_video_fns[0]
-
-            p = videodir+"/%s*"%row["Right"]
-            right_video_fns = glob(p)
-            assert len(right_video_fns) == 1, \
-                f"File pattern {p} is found {len(right_video_fns)} times, please make sure it's unique" 
-            right_video_fn = right_video_fns[0]
-
-            left_video = process_video(left_video_fn, duration=duration,
-                                **video_setting["objects"]["Left"])
-            right_video = process_video(right_video_fn, duration=duration,
-                                **video_setting["objects"]["Right"])
-            videos = [left_video, right_video]
-        
-        elif train_identifier in protocoldf.columns:
-            # for training movie making with center object
-            p = videodir+"/%s*"%row["Object"]
-            video_fns = glob(p)
-            assert len(video_fns) == 1, \
-                f"File pattern {p} is found {len(video_fns)} times, please make sure it's unique"
-            video_fn = video_fns[0]
-
-            video = process_video(video_fn, duration=duration,
-                            **video_setting["objects"]["Object"])
-            videos = [video]
-        
-        else:
-            raise Exception("Neither %s or %s can be found in the columns;\
-                             Make sure you have the right protocol csv fomat"\
-                             %(test_identifier, train_identifier))
-
-        # compose
-        outvideo = compose(videos=videos,
-                           audio=audio,
-                           output_size=(w, h),
-                           bg_color=bg_color)
-
-        if verbose:
-            print("\nWriting to %s"%outname)
-            logger = "bar"
+
+        videos = find_row_videos(row, protocoldf.columns, videodir,
+                                 video_setting,
+                                 test_identifier=test_identifier,
+                                 train_identifier=train_identifier,
+                                 globber=globber)
+        plans.append((row, outname, videos))
+
+    batches = schedule_by_source(plans, max_sinks)
+    kwargs = dict(audiodir=audiodir, output_size=(w, h), bg_color=bg_color,
+                  fps=fps, codec=codec, preset=preset, threads=threads,
+                  verbose=verbose, globber=globber)
+    def finish(batch, result):
+        outnames = [outname for _, outname, _ in batch]
+        try:
+            result()
+        except Exception as e:
+            if done is None:
+                raise
+            done(outnames, e)
         else:
-            logger = None
-        
-        outvideo.write_videofile(outname, codec=codec,
-                                 audio_codec='aac',
-                                 remove_temp=True,
-                                 fps=fps,
-                                 logger=logger)
-        
-        # close the opened videos
-        for v in videos:
-            v.close()
-        outvideo.close()
-        audio.close()
+            if done is not None:
+                done(outnames, None)
+
+    if jobs > 1 and len(batches) > 1:
+        # the source cache can't be shared, workers open their own sources
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_batch, batch, **kwargs)
+                       for batch in batches]
+            for batch, future in zip(batches, futures):
+                finish(batch, future.result)
+    else:
+        for batch in batches:
+            finish(batch, lambda: render_batch(batch,
+                                               source_cache=source_cache,
+                                               **kwargs))
+
+
+def row_signature(row, protocoldf, audiodir, videodir, video_setting,
+                  globber=glob):
+    '''
+        Everything the output of a protocol row depends on:
+        the row, the video setting and the mtimes of its source files
+    '''
+    fns = [fn for fn, _ in find_row_videos(row, protocoldf.columns,
+                                           videodir, video_setting,
+                                           globber=globber)]
+    audiofn = find_audio(row["Audio_file"], audiodir, globber)
+    if audiofn is not None:
+        fns.append(audiofn)
+    return (repr(row.to_dict()), repr(video_setting),
+            tuple((fn, os.path.getmtime(fn)) for fn in fns))
+
+
+def watch_clip_with_protocol(configfn, interval=1.0, verbose=1,
+                             max_sources=32, **kwargs):
+    '''
+        Stay resident, re-render the rows affected by each change of the
+        config, the protocol csv or the media directories
+        max_sources: number of opened sources kept between renders
+        kwargs: encoding settings passed to make_clip_with_protocol,
+        rendering stays in this process (jobs=1) to keep the caches warm
+    '''
+    kwargs["jobs"] = 1
+    glob_cache = GlobCache()
+    source_cache = SourceCache(max_sources=max_sources)
+    rendered = {}  # output file -> row signature of its last render
+
+    def render(old, new):
+        if set(old) != set(new):
+            # files added or removed, lookups may have changed
+            glob_cache.clear()
+            source_cache.prune()
+        protocoldf, audiodir, videodir, outdir,\
+             video_setting, saveconfig, reprocess\
+                 = load_config(configfn)
+        todo, signatures, referenced = [], {}, set()
+        for idx, row in protocoldf.iterrows():
+            outname = os.path.join(outdir, row["Output_file"])
+            try:
+                signature = row_signature(row, protocoldf, audiodir,
+                                          videodir, video_setting,
+                                          glob_cache.glob)
+            except Exception as e:
+                print("\n\nWARNING: ", e)
+                print("SKIP %s until its sources change\n\n"%outname)
+                continue
+            referenced.update(fn for fn, _ in signature[2])
+            if rendered.get(outname) == signature:
+                continue
+            if not rendered and not reprocess and os.path.exists(outname):
+                # the first pass follows the config
+                if verbose:
+                    print("\nSKIP found existing %s"%outname)
+                rendered[outname] = signature
+                continue
+            todo.append(idx)
+            signatures[outname] = signature
+        # close the sources the protocol doesn't use anymore
+        source_cache.retain(referenced)
+        if not todo:
+            return
+        if verbose and rendered:
+            print("\nChange detected, re-rendering %s clip(s)"%len(todo))
+
+        failed = []
+
+        def done(outnames, error):
+            # record each batch as it finishes, a bad row doesn't make
+            # the others render again
+            if error is None:
+                for outname in outnames:
+                    rendered[outname] = signatures[outname]
+            else:
+                print("\n\nWARNING: ", error)
+                print("FAILED %s\n\n"%", ".join(outnames))
+                failed.extend(outnames)
+
+        make_clip_with_protocol(protocoldf.loc[todo], outdir,
+                                audiodir, videodir, video_setting,
+                                verbose=verbose,
+                                reprocess=True,
+                                globber=glob_cache.glob,
+                                source_cache=source_cache,
+                                done=done,
+                                **kwargs)
+        source_cache.retain()
+        if saveconfig:
+            shutil.copy(configfn, outdir)
+        if failed:
+            raise Exception("%s clip(s) failed to render"%len(failed))
+
+    try:
+        watch(lambda: config_paths(configfn), render,
+              interval=interval, verbose=verbose)
+    finally:
+        source_cache.close()
 
 
 def main():
@@ -206,15 +496,28 @@ def main():
            help="configuration file for concatenating audio files")
     parser.add_argument('-v', '--verbose', default=1, type=int,
            help="verbose level, 0 or 1")
+    parser.add_argument('-w', '--watch', action='store_true',
+           help="keep running and re-render clips when the config, "
+                "protocol csv or media files change")
+    parser.add_argument('--interval', default=1.0, type=float,
+           help="polling interval in seconds for --watch")
     args = parser.parse_args()
 
+    # encoding settings written by the autotune command
+    profile = load_profile("clipcreator", verbose=args.verbose)
+    if args.watch:
+        watch_clip_with_protocol(args.config, interval=args.interval,
+                                 verbose=bool(args.verbose), **profile)
+        return
+
     protocoldf, audiodir, videodir, outdir,\
          video_setting, saveconfig, reprocess\
              = load_config(args.config)
     make_clip_with_protocol(protocoldf, outdir, 
                              audiodir, videodir, video_setting,
                              verbose=bool(args.verbose),
-                             reprocess=reprocess)
+                             reprocess=reprocess,
+                             **profile)
     if saveconfig:
         shutil.copy(args.config, outdir)
 
@@ -0,0 +1,51 @@
+import os
+import yaml
+import socket
+
+# encoding settings of make_clip_with_protocol / make_movie_with_protocol
+# that are tuned per machine by the biliwalle-autotune command
+PROFILE_KEYS = ("jobs", "threads", "preset")
+
+
+def profile_path(tool):
+    '''
+        Profile of a tool (clipcreator or biliwalle), in BILIWALLE_PROFILE_DIR
+        if set, otherwise in ~/.biliwalle
+    '''
+    profiledir = os.environ.get("BILIWALLE_PROFILE_DIR",
+                                os.path.join(os.path.expanduser("~"),
+                                             ".biliwalle"))
+    return os.path.join(profiledir, "%s_profile.yml"%tool)
+
+
+def save_profile(profile, tool, profilefn=None):
+    profilefn = profilefn or profile_path(tool)
+    profiledir = os.path.dirname(profilefn)
+    if profiledir and not os.path.exists(profiledir):
+        os.makedirs(profiledir)
+    profile = dict(profile, tool=tool, hostname=socket.gethostname())
+    with open(profilefn, "w") as fh:
+        yaml.dump(profile, fh, default_flow_style=False)
+    return profilefn
+
+
+def load_profile(tool, profilefn=None, verbose=1):
+    '''
+        Encoding settings of a tool on this machine, {} if it hasn't been
+        autotuned. A profile tuned on another host (e.g. shared home
+        directory) is ignored.
+    '''
+    profilefn = profilefn or profile_path(tool)
+    if not os.path.exists(profilefn):
+        return {}
+    with open(profilefn) as fh:
+        profile = yaml.load(fh, Loader=yaml.Loader) or {}
+    hostname = profile.get("hostname")
+    if hostname and hostname != socket.gethostname():
+        if verbose:
+            print("\nWARNING: %s was tuned on %s, run biliwalle-autotune "
+                  "on this machine"%(profilefn, hostname))
+        return {}
+    if verbose:
+        print("\nUsing machine profile %s"%profilefn)
+    return {k: profile[k] for k in PROFILE_KEYS if k in profile}
@@ -0,0 +1,148 @@
+import os
+import time
+import yaml
+import traceback
+from glob import glob
+from collections import OrderedDict
+
+
+def config_paths(configfn, keys=("protocolcsv", "audiodir", "videodir")):
+    '''
+        The config file itself plus the data paths it points to
+    '''
+    paths = [configfn]
+    try:
+        with open(configfn) as fh:
+            config = yaml.load(fh, Loader=yaml.Loader)
+    except Exception:
+        return paths
+    data = (config or {}).get("data", {}) or {}
+    for key in keys:
+        if data.get(key):
+            paths.append(data[key])
+    return paths
+
+
+def snapshot(paths):
+    '''
+        Map every file under paths (files or directories) to its mtime
+    '''
+    state = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, fns in os.walk(path):
+                for fn in fns:
+                    fp = os.path.join(root, fn)
+                    try:
+                        state[fp] = os.path.getmtime(fp)
+                    except OSError:
+                        continue
+        elif os.path.exists(path):
+            state[path] = os.path.getmtime(path)
+    return state
+
+
+def watch(get_paths, callback, interval=1.0, verbose=1, retries=3):
+    '''
+        Poll the paths returned by get_paths() and call
+        callback(old_snapshot, new_snapshot) on start and whenever a file
+        is added, removed or modified. get_paths is re-evaluated on every
+        poll so that edits to the config can move the watched directories.
+        A failed callback (e.g. a protocol csv read half-way through being
+        saved) is retried on the next polls, up to retries times, then
+        watching continues until the next change.
+    '''
+    old = {}
+    new = snapshot(get_paths())
+    failures = 0
+    try:
+        while True:
+            if new != old:
+                try:
+                    callback(old, new)
+                    failures = 0
+                except Exception:
+                    failures += 1
+                    traceback.print_exc()
+                    if failures <= retries:
+                        print("\n\nWARNING: render failed, retrying (%s/%s)"\
+                              %(failures, retries))
+                    else:
+                        print("\n\nWARNING: render failed, "
+                              "waiting for next change")
+                        failures = 0
+                if not failures:
+                    old = new
+                    if verbose:
+                        print("\nWatching for changes, press Ctrl-C to stop")
+            time.sleep(interval)
+            new = snapshot(get_paths())
+    except KeyboardInterrupt:
+        if verbose:
+            print("\nStop watching")
+
+
+class GlobCache(object):
+    '''
+        Memoized glob, to be cleared when files are added or removed
+    '''
+    def __init__(self):
+        self.results = {}
+
+    def glob(self, pattern):
+        if pattern not in self.results:
+            self.results[pattern] = glob(pattern)
+        return list(self.results[pattern])
+
+    def clear(self):
+        self.results = {}
+
+
+class SourceCache(object):
+    '''
+        Keep opened (decoded) media sources between renders.
+        A source is reopened when its file mtime changes. Each opened
+        source holds an ffmpeg reader, call retain() between renders to
+        close the least recently used ones.
+    '''
+    def __init__(self, max_sources=32):
+        self.max_sources = max_sources
+        self.clips = OrderedDict()  # least recently used first
+
+    def get(self, fn, loader):
+        mtime = os.path.getmtime(fn)
+        cached = self.clips.get(fn)
+        if cached is not None:
+            if cached[0] == mtime:
+                self.clips.move_to_end(fn)
+                return cached[1]
+            self.clips.pop(fn)[1].close()
+        clip = loader(fn)
+        self.clips[fn] = (mtime, clip)
+        return clip
+
+    def prune(self):
+        '''
+            Close the sources whose file has been removed
+        '''
+        for fn in list(self.clips):
+            if not os.path.exists(fn):
+                self.clips.pop(fn)[1].close()
+
+    def retain(self, keep=None):
+        '''
+            Close the sources not in keep (if given), then the least
+            recently used ones above max_sources. Not to be called
+            during a render, the closed sources may still be in use.
+        '''
+        if keep is not None:
+            keep = set(keep)
+            for fn in list(self.clips):
+                if fn not in keep:
+                    self.clips.pop(fn)[1].close()
+        while len(self.clips) > self.max_sources:
+            self.clips.popitem(last=False)[1][1].close()
+
+    def close(self):
+        for fn in list(self.clips):
+            self.clips.pop(fn)[1].close()
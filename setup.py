@@ -26,6 +26,7 @@ setup(
             'waveweaver=biliwalle.waveweaver:main',
             'clipcreator=biliwalle.clipcreator:main',
             'biliwalle=biliwalle.biliwalle:main',
+            'biliwalle-autotune=biliwalle.autotune:main',
         ],
     },
     classifiers=[ 
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("moviepy.editor")
+from biliwalle.autotune import sample_protocol
+from biliwalle.clipcreator import find_row_videos, find_audio, \
+                                  schedule_by_source
+
+
+NAMES = ["sample%02d"%i for i in range(6)]
+OBJECT = dict(resize_to_width=100, resize_to_height=56,
+              position_x=160, position_y=90)
+
+
+def test_sample_protocol_clipcreator(tmp_path):
+    for name in NAMES:
+        (tmp_path / (name + ".mp4")).write_text("")
+    for objects in ({"Left": OBJECT, "Right": OBJECT}, {"Object": OBJECT}):
+        video_setting = {"out_width": 320, "out_height": 180,
+                         "objects": objects}
+        protocoldf = sample_protocol("clipcreator", video_setting, NAMES,
+                                     rows_per_group=2, duration=1)
+        assert len(protocoldf) == 6
+        assert protocoldf["Output_file"].is_unique
+        plans = []
+        for _, row in protocoldf.iterrows():
+            # the rows resolve as make_clip_with_protocol resolves them
+            assert find_audio(row["Audio_file"], str(tmp_path)) is None
+            videos = find_row_videos(row, protocoldf.columns,
+                                     str(tmp_path), video_setting)
+            plans.append((row, row["Output_file"], videos))
+        # one independent batch per pair of sources
+        assert len(schedule_by_source(plans, max_sinks=10)) == 3
+
+
+def test_sample_protocol_biliwalle():
+    protocoldf = sample_protocol("biliwalle", {}, NAMES,
+                                 rows_per_group=2, duration=1)
+    assert {"Order", "Video_file", "Trial_type", "Output_video_file"} \
+           <= set(protocoldf.columns)
+    assert protocoldf["Order"].nunique() == 6
+    assert protocoldf.groupby("Order")["Output_video_file"].nunique()\
+                     .eq(1).all()
+    assert set(protocoldf["Video_file"]) == set(n + ".mp4" for n in NAMES)
@@ -0,0 +1,36 @@
+import os
+import pytest
+
+pytest.importorskip("moviepy.editor")
+import pandas as pd
+from biliwalle.biliwalle import group_signature
+
+
+def test_group_signature_detects_edited_movie(tmp_path):
+    for name in ("A", "B", "C"):
+        (tmp_path / (name + ".mp4")).write_text("")
+    protocoldf = pd.DataFrame({
+        "Order": [1, 1, 2, 2],
+        "Video_file": ["A.mp4", "B.mp4", "B.mp4", "C.mp4"],
+        "Trial_type": ["test"] * 4,
+        "Output_video_file": ["1.mp4", "1.mp4", "2.mp4", "2.mp4"],
+    })
+    video_setting = {"out_width": 320, "out_height": 180}
+
+    def signatures(df):
+        return {order: group_signature(grp, str(tmp_path), video_setting)
+                for order, grp in df.groupby("Order")}
+
+    before = signatures(protocoldf)
+    assert signatures(protocoldf) == before
+
+    # edited row
+    edited = protocoldf.copy()
+    edited.loc[3, "Video_file"] = "A.mp4"
+    after = signatures(edited)
+    assert after[1] == before[1] and after[2] != before[2]
+
+    # modified video file
+    os.utime(str(tmp_path / "A.mp4"), (1000, 1000))
+    after = signatures(protocoldf)
+    assert after[1] != before[1] and after[2] == before[2]
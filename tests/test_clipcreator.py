@@ -0,0 +1,228 @@
+import os
+import pytest
+
+pytest.importorskip("moviepy.editor")
+import numpy as np
+import pandas as pd
+from moviepy.editor import ImageClip, VideoFileClip
+from biliwalle.clipcreator import schedule_by_source, make_clip_with_protocol
+
+
+def plan(outname, *fns):
+    return (None, outname, [(fn, {}) for fn in fns])
+
+
+def test_schedule_by_source_groups_shared_sources():
+    plans = [plan("1", "A", "B"), plan("2", "C", "D"),
+             plan("3", "B", "E"), plan("4", "A", "B")]
+    batches = schedule_by_source(plans, max_sinks=10)
+    outnames = sorted(sorted(p[1] for p in batch) for batch in batches)
+    assert outnames == [["1", "3", "4"], ["2"]]
+
+
+def test_schedule_by_source_respects_max_sinks():
+    plans = [plan(str(i), "A", "B%s"%i) for i in range(5)]
+    batches = schedule_by_source(plans, max_sinks=2)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sorted(p[1] for batch in batches for p in batch) == \
+           [str(i) for i in range(5)]
+
+
+def write_static_video(fn, color, size=(320, 180), duration=2):
+    w, h = size
+    frame = np.full((h, w, 3), color, dtype="uint8")
+    frame[h // 4:h // 2, w // 4:w // 2] = 0
+    clip = ImageClip(frame)
+    try:
+        clip = clip.with_duration(duration)
+    except:
+        clip = clip.set_duration(duration)
+    clip.write_videofile(fn, fps=30, codec="libx264", logger=None)
+    clip.close()
+
+
+def test_shared_source_first_frame(tmp_path):
+    '''
+        frame 0 of a static layout matches frame 1, also for rows sharing
+        a source video
+    '''
+    videodir = tmp_path / "videos"
+    outdir = tmp_path / "out"
+    videodir.mkdir()
+    write_static_video(str(videodir / "A.mp4"), (200, 30, 30))
+    write_static_video(str(videodir / "B.mp4"), (30, 30, 200))
+    protocoldf = pd.DataFrame({
+        "Test_trial_ID": [1, 2],
+        "Left": ["A", "A"],
+        "Right": ["B", "A"],
+        "Audio_file": ["silence_1s", "silence_1s"],
+        "Output_file": ["AB.mp4", "AA.mp4"],
+    })
+    video_setting = {
+        "out_width": 320,
+        "out_height": 180,
+        "bg_color": [255, 255, 255],
+        "objects": {
+            "Left": dict(resize_to_width=80, resize_to_height=46,
+                         position_x=80, position_y=90),
+            "Right": dict(resize_to_width=80, resize_to_height=46,
+                          position_x=240, position_y=90),
+        },
+    }
+    make_clip_with_protocol(protocoldf, str(outdir), str(tmp_path) + "/",
+                            str(videodir), video_setting, verbose=0)
+
+    for outname in protocoldf["Output_file"]:
+        clip = VideoFileClip(os.path.join(str(outdir), outname))
+        first = clip.get_frame(0).astype(float)
+        second = clip.get_frame(1 / 30).astype(float)
+        clip.close()
+        assert np.abs(first - second).mean() < 5
+
+
+def watch_setup(tmp_path, monkeypatch, fail=()):
+    '''
+        A clipcreator config in tmp_path, returns the watch callback and
+        the list of output files passed to each make_clip_with_protocol
+    '''
+    import biliwalle.clipcreator as clipcreator
+    videodir = tmp_path / "videos"
+    videodir.mkdir()
+    for name in ("A", "B", "C"):
+        (videodir / (name + ".mp4")).write_text("")
+    protocolcsv = tmp_path / "protocol.csv"
+    configfn = tmp_path / "config.yml"
+    configfn.write_text(
+        "data:\n"
+        "  protocolcsv: %s\n  audiodir: %s/\n  videodir: %s\n  outdir: %s\n"
+        "video_setting:\n  out_width: 320\n  out_height: 180\n"
+        "  objects: {Left: {}, Right: {}}\n"
+        "other:\n  saveconfig: False\n"
+        %(protocolcsv, tmp_path, videodir, tmp_path / "out"))
+
+    callbacks, calls = [], []
+    monkeypatch.setattr(clipcreator, "watch",
+        lambda get_paths, callback, **kwargs: callbacks.append(callback))
+
+    def fake_make_clip(protocoldf, outdir, *args, **kwargs):
+        outnames = [os.path.join(outdir, fn)
+                    for fn in protocoldf["Output_file"]]
+        calls.append(sorted(os.path.basename(fn) for fn in outnames))
+        for outname in outnames:
+            error = ValueError("corrupt") \
+                    if os.path.basename(outname) in fail else None
+            kwargs["done"]([outname], error)
+
+    monkeypatch.setattr(clipcreator, "make_clip_with_protocol",
+                        fake_make_clip)
+    clipcreator.watch_clip_with_protocol(str(configfn), verbose=0)
+    return callbacks[0], calls, protocolcsv, videodir
+
+
+def write_protocol(protocolcsv, rights):
+    pd.DataFrame({"Test_trial_ID": range(len(rights)),
+                  "Left": ["A"] * len(rights),
+                  "Right": rights,
+                  "Audio_file": ["silence_1s"] * len(rights),
+                  "Output_file": ["%s.mp4"%i for i in range(len(rights))]})\
+      .to_csv(str(protocolcsv), index=False)
+
+
+def test_watch_renders_only_edited_row(tmp_path, monkeypatch):
+    render, calls, protocolcsv, _ = watch_setup(tmp_path, monkeypatch)
+    write_protocol(protocolcsv, ["B", "C"])
+    render({}, {"a": 1})
+    assert calls == [["0.mp4", "1.mp4"]]
+    render({"a": 1}, {"a": 1})
+    assert len(calls) == 1
+    write_protocol(protocolcsv, ["B", "B"])
+    render({"a": 1}, {"a": 1})
+    assert calls[-1] == ["1.mp4"]
+
+
+def test_watch_clears_globs_on_added_file(tmp_path, monkeypatch):
+    render, calls, protocolcsv, videodir = watch_setup(tmp_path,
+                                                       monkeypatch)
+    write_protocol(protocolcsv, ["B", "D"])
+    render({}, {"a": 1})
+    # D doesn't exist yet, its row is skipped
+    assert calls == [["0.mp4"]]
+    (videodir / "D.mp4").write_text("")
+    render({"a": 1}, {"a": 1, "d": 1})
+    assert calls[-1] == ["1.mp4"]
+
+
+def test_watch_records_rows_as_they_finish(tmp_path, monkeypatch):
+    render, calls, protocolcsv, _ = watch_setup(tmp_path, monkeypatch,
+                                                fail=("1.mp4",))
+    write_protocol(protocolcsv, ["B", "C", "B"])
+    with pytest.raises(Exception):
+        render({}, {"a": 1})
+    assert calls == [["0.mp4", "1.mp4", "2.mp4"]]
+    # the retry only renders the failed row
+    with pytest.raises(Exception):
+        render({}, {"a": 1})
+    assert calls[-1] == ["1.mp4"]
+
+
+def test_fanout_decodes_shared_sources_once(tmp_path, monkeypatch):
+    '''
+        A batch reads each shared source once per frame, and writes the
+        same frames as single-row batches
+    '''
+    from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+    videodir = tmp_path / "videos"
+    videodir.mkdir()
+    for name, color in (("A", (200, 30, 30)), ("B", (30, 200, 30)),
+                        ("C", (30, 30, 200))):
+        write_static_video(str(videodir / (name + ".mp4")), color)
+    protocoldf = pd.DataFrame({
+        "Test_trial_ID": [1, 2, 3],
+        "Left": ["A", "B", "C"],
+        "Right": ["B", "C", "A"],
+        "Audio_file": ["silence_1s"] * 3,
+        "Output_file": ["AB.mp4", "BC.mp4", "CA.mp4"],
+    })
+    objects = {
+        "Left": dict(resize_to_width=80, resize_to_height=46,
+                     position_x=80, position_y=90),
+        "Right": dict(resize_to_width=80, resize_to_height=46,
+                      position_x=240, position_y=90),
+    }
+
+    read_frame = FFMPEG_VideoReader.read_frame
+    reads = []
+
+    def counting_read_frame(self, *args, **kwargs):
+        reads.append(1)
+        return read_frame(self, *args, **kwargs)
+
+    monkeypatch.setattr(FFMPEG_VideoReader, "read_frame",
+                        counting_read_frame)
+
+    counts, outdirs = [], []
+    # one batch for the 3 rows, then a budget forcing single-row batches
+    for name, memory_budget_mb in (("batched", 1024), ("single", 0.001)):
+        video_setting = {"out_width": 320, "out_height": 180,
+                         "memory_budget_mb": memory_budget_mb,
+                         "objects": objects}
+        outdir = str(tmp_path / name)
+        del reads[:]
+        make_clip_with_protocol(protocoldf, outdir, str(tmp_path) + "/",
+                                str(videodir), video_setting, verbose=0)
+        counts.append(len(reads))
+        outdirs.append(outdir)
+
+    batched, single = counts
+    # 30 frames of 3 sources, plus the first read when opening a source
+    assert batched <= 3 * (30 + 2)
+    assert batched * 2 <= single + 6
+
+    for outname in protocoldf["Output_file"]:
+        clips = [VideoFileClip(os.path.join(outdir, outname))
+                 for outdir in outdirs]
+        for t in (0, 0.5, 29 / 30):
+            frames = [clip.get_frame(t).astype(float) for clip in clips]
+            assert np.abs(frames[0] - frames[1]).mean() < 1
+        for clip in clips:
+            clip.close()
@@ -0,0 +1,47 @@
+import os
+import yaml
+import pytest
+
+from biliwalle.machine_profile import save_profile, load_profile, \
+                                      profile_path, PROFILE_KEYS
+
+
+@pytest.fixture
+def profiledir(tmp_path, monkeypatch):
+    monkeypatch.setenv("BILIWALLE_PROFILE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_profile_dir_from_env(profiledir):
+    assert profile_path("clipcreator") == \
+           str(profiledir / "clipcreator_profile.yml")
+    assert profile_path("biliwalle") != profile_path("clipcreator")
+
+
+def test_profile_round_trip(profiledir):
+    profilefn = save_profile(dict(jobs=2, threads=4, preset="veryfast",
+                                  throughput=12.5, peak_memory_mb=300.0),
+                             "clipcreator")
+    assert profilefn == profile_path("clipcreator")
+    # only the encoding settings are passed to the tool
+    assert load_profile("clipcreator", verbose=0) == \
+           dict(jobs=2, threads=4, preset="veryfast")
+    assert set(load_profile("clipcreator", verbose=0)) == set(PROFILE_KEYS)
+    # per tool
+    assert load_profile("biliwalle", verbose=0) == {}
+
+
+def test_profile_from_other_host_is_ignored(profiledir):
+    profilefn = save_profile(dict(jobs=2, threads=4, preset="veryfast"),
+                             "biliwalle")
+    with open(profilefn) as fh:
+        profile = yaml.load(fh, Loader=yaml.Loader)
+    profile["hostname"] = "another-machine"
+    with open(profilefn, "w") as fh:
+        yaml.dump(profile, fh)
+    assert load_profile("biliwalle", verbose=0) == {}
+
+
+def test_missing_profile(profiledir):
+    assert not os.path.exists(profile_path("clipcreator"))
+    assert load_profile("clipcreator", verbose=0) == {}
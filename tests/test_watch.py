@@ -0,0 +1,138 @@
+import os
+import types
+import pytest
+
+import biliwalle.watch as watchmod
+from biliwalle.watch import GlobCache, SourceCache, snapshot
+
+
+class FakeClip(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def touch(fn, mtime=None):
+    with open(fn, "w") as fh:
+        fh.write("")
+    if mtime is not None:
+        os.utime(fn, (mtime, mtime))
+
+
+def fake_time(monkeypatch, polls, on_poll=None):
+    '''
+        Replace time.sleep in watch, stop watching after polls sleeps
+    '''
+    count = []
+
+    def sleep(_):
+        count.append(1)
+        if on_poll is not None:
+            on_poll(len(count))
+        if len(count) >= polls:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(watchmod, "time", types.SimpleNamespace(sleep=sleep))
+
+
+def test_glob_cache_clear(tmp_path):
+    touch(str(tmp_path / "A1.mp4"))
+    cache = GlobCache()
+    pattern = str(tmp_path / "A*")
+    assert len(cache.glob(pattern)) == 1
+    touch(str(tmp_path / "A2.mp4"))
+    assert len(cache.glob(pattern)) == 1  # memoized
+    cache.clear()
+    assert len(cache.glob(pattern)) == 2
+    os.remove(str(tmp_path / "A1.mp4"))
+    cache.clear()
+    assert cache.glob(pattern) == [str(tmp_path / "A2.mp4")]
+
+
+def test_source_cache_reopens_on_mtime_change(tmp_path):
+    fn = str(tmp_path / "A.mp4")
+    touch(fn, mtime=1000)
+    cache = SourceCache()
+    first = cache.get(fn, FakeClip)
+    assert cache.get(fn, FakeClip) is first
+    os.utime(fn, (2000, 2000))
+    second = cache.get(fn, FakeClip)
+    assert second is not first
+    assert first.closed and not second.closed
+
+
+def test_source_cache_prune(tmp_path):
+    fns = [str(tmp_path / name) for name in ("A.mp4", "B.mp4")]
+    for fn in fns:
+        touch(fn)
+    cache = SourceCache()
+    clips = [cache.get(fn, FakeClip) for fn in fns]
+    os.remove(fns[0])
+    cache.prune()
+    assert clips[0].closed and not clips[1].closed
+    assert list(cache.clips) == [fns[1]]
+
+
+def test_source_cache_retain(tmp_path):
+    fns = [str(tmp_path / ("%s.mp4"%i)) for i in range(4)]
+    for fn in fns:
+        touch(fn)
+    cache = SourceCache(max_sources=2)
+    clips = [cache.get(fn, FakeClip) for fn in fns]
+    cache.get(fns[0], FakeClip)  # most recently used
+    cache.retain(fns[:3])
+    assert clips[3].closed
+    # least recently used above max_sources
+    assert clips[1].closed
+    assert list(cache.clips) == [fns[2], fns[0]]
+
+
+def test_watch_retries_failed_callback(tmp_path, monkeypatch):
+    fn = str(tmp_path / "protocol.csv")
+    touch(fn)
+    calls = []
+
+    def callback(old, new):
+        calls.append(new)
+        raise ValueError("half-saved csv")
+
+    fake_time(monkeypatch, polls=8)
+    watchmod.watch(lambda: [fn], callback, verbose=0, retries=3)
+    # the first attempt and 3 retries, then wait for the next change
+    assert len(calls) == 4
+
+
+def test_watch_retry_succeeds(tmp_path, monkeypatch):
+    fn = str(tmp_path / "protocol.csv")
+    touch(fn)
+    calls = []
+
+    def callback(old, new):
+        calls.append(old)
+        if len(calls) == 1:
+            raise ValueError("half-saved csv")
+
+    fake_time(monkeypatch, polls=5)
+    watchmod.watch(lambda: [fn], callback, verbose=0)
+    assert len(calls) == 2
+    # the retry still sees the change from the last handled snapshot
+    assert calls[1] == {}
+
+
+def test_watch_calls_again_on_change(tmp_path, monkeypatch):
+    fn = str(tmp_path / "protocol.csv")
+    touch(fn, mtime=1000)
+    calls = []
+
+    def on_poll(n):
+        if n == 2:
+            os.utime(fn, (2000, 2000))
+
+    fake_time(monkeypatch, polls=5, on_poll=on_poll)
+    watchmod.watch(lambda: [fn], lambda old, new: calls.append(new),
+                   verbose=0)
+    assert calls == [{fn: 1000}, {fn: 2000}]
+    assert snapshot([str(tmp_path)]) == {fn: 2000}